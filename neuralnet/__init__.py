@@ -9,6 +9,7 @@ from .metrics import *
 from .optimization import *
 from .init import *
 from .extras import *
+from .ops import *
 from .utils import *
 from .build_training import *
 from .monitor import *
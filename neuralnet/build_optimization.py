@@ -45,6 +45,13 @@ class Optimization(utils.ConfigParser):
         return cost
 
     def build_updates(self, cost, trainable, **kwargs):
+        """
+        Builds the optimizer updates for trainable and merges in the updates the
+        layers themselves own, e.g. the running mean/var of normalization layers,
+        which do not self-apply via default_update anymore. Passing the returned
+        dict to theano.function is what keeps those statistics tracking during
+        training.
+        """
         method = kwargs.pop('method', self.method)
         if 'lr' not in kwargs.keys():
             kwargs['lr'] = self.learning_rate
@@ -61,6 +68,7 @@ class Optimization(utils.ConfigParser):
         kwargs['return_op'] = True
 
         self.opt, updates = optimizer.get(method.lower(), sgd)(cost, trainable, **kwargs)
+        updates.update(getattr(self, 'updates', {}))
         return updates
 
     def build_regularization(self, params, **kwargs):
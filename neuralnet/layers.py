@@ -4,8 +4,10 @@ Written and collected by Duc Nguyen
 __author__ = 'Duc Nguyen'
 
 import abc
+import logging
 import time
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 
 import numpy as np
@@ -44,22 +46,61 @@ class NetMethod:
     def __call__(self, *args, **kwargs):
         return self.get_output(*args, **kwargs)
 
-    def save_params(self, param_file=None):
+    def save_params(self, param_file=None, dtype=None):
+        """
+        dumps the model weights to ``param_file``. Passing ``dtype='float16'``
+        halves the archive size and the bytes read back at load time; the load
+        path casts each array back to the parameter dtype, so the network
+        itself is unchanged.
+
+        :param param_file: the file to dump the weights to. Default is ``self.param_file``
+        :param dtype: an optional storage dtype for the dumped arrays. Default is the parameter dtype
+        :return:
+        """
         param_file = param_file if param_file else self.param_file
-        np.savez(param_file, **{p.name: p.get_value() for p in self.params})
-        print('Model weights dumped to %s' % param_file)
+        values = {p.name: p.get_value() for p in self.params}
+        if dtype is not None:
+            values = {name: value.astype(dtype) for name, value in values.items()}
+        np.savez(param_file, **values)
+        logging.info('Model weights dumped to %s', param_file)
 
     def load_params(self, param_file=None):
         param_file = param_file if param_file else self.param_file
-        weights = np.load(param_file)
-        weights_vals_tuple = []
+        self._set_params(np.load(param_file, allow_pickle=False))
+        logging.info('Model weights loaded from %s', param_file)
+
+    def load_params_async(self, param_file=None):
+        """
+        starts reading the weight archive on a background thread so the disk read
+        overlaps Theano function compilation. np.load on an npz archive is lazy,
+        so the worker materializes every array into a dict; yielding the archive
+        itself would defer the actual byte reads to the caller's thread. Call
+        :meth:`finish_load_params` on the returned future once compilation is done.
+
+        :param param_file: the weight archive to read. Default is ``self.param_file``
+        :return: a :class:`concurrent.futures.Future` resolving to a dict of weights
+        """
+        param_file = param_file if param_file else self.param_file
+
+        def read():
+            with np.load(param_file, allow_pickle=False) as archive:
+                return {name: archive[name] for name in archive.files}
+
+        executor = ThreadPoolExecutor(max_workers=1)
+        future = executor.submit(read)
+        executor.shutdown(wait=False)
+        return future
+
+    def finish_load_params(self, future):
+        self._set_params(future.result())
+        logging.info('Model weights loaded')
+
+    def _set_params(self, weights):
+        saved = set(getattr(weights, 'files', weights))
         for p in self.params:
-            try:
-                weights_vals_tuple.append((p, weights[p.name]))
-            except KeyError:
-                KeyError('There is no saved weight for %s. Skipped!' % p.name)
-        utils.batch_set_value(weights_vals_tuple)
-        print('Model weights loaded from %s' % param_file)
+            if p.name not in saved:
+                logging.warning('There is no saved weight for %s. Skipped!' % p.name)
+        utils.batch_set_value([(p, weights[p.name]) for p in self.params if p.name in saved])
 
 
 class Layer(NetMethod, metaclass=abc.ABCMeta):
@@ -73,9 +114,30 @@ class Layer(NetMethod, metaclass=abc.ABCMeta):
         self.params = []
         self.trainable = []
         self.regularizable = []
+        self._updates = OrderedDict()
         self.layer_name = layer_name
         self.descriptions = ''
 
+    @property
+    def updates(self):
+        # composite layers (Inception modules, DenseBlock, the ResNet blocks)
+        # own their sub-layers as attributes or (nested) lists of them, so the
+        # running-stat updates of a nested normalization layer are collected by
+        # recursing through whatever the layer owns
+        updates = OrderedDict(self._updates)
+        for attr in self.__dict__.values():
+            for child in self._iter_sub_layers(attr):
+                updates.update(child.updates)
+        return updates
+
+    @staticmethod
+    def _iter_sub_layers(attr):
+        if isinstance(attr, (Layer, Sequential)):
+            yield attr
+        elif isinstance(attr, (list, tuple)):
+            for item in attr:
+                yield from Layer._iter_sub_layers(item)
+
     @staticmethod
     def set_training_status(training):
         Layer.training_flag = training
@@ -114,19 +176,8 @@ class Sequential(OrderedDict, NetMethod):
         else:
             super(Sequential, self).__init__(layers)
 
-        self.__idx = 0
-        self.__max = len(self)
-
     def __iter__(self):
-        self.__idx = 0
-        self.__max = len(self)
-        return self
-
-    def __next__(self):
-        if self.__idx >= self.__max:
-            raise StopIteration
-        self.__idx += 1
-        return self[self.__idx - 1]
+        return iter(self.values())
 
     def __getitem__(self, item):
         assert isinstance(item, (int, slice, str)), 'index should be either str, int or slice, got %s.' % type(item)
@@ -168,6 +219,13 @@ class Sequential(OrderedDict, NetMethod):
         else:
             return self.input_shape
 
+    @property
+    def updates(self):
+        updates = OrderedDict()
+        for layer in self.values():
+            updates.update(layer.updates)
+        return updates
+
     def append(self, layer):
         if not isinstance(layer, (Sequential, Layer)):
             raise TypeError('layer must be an instance of Layer or Sequential, got %s.' % type(layer))
@@ -203,9 +261,6 @@ class Sequential(OrderedDict, NetMethod):
 
         for key in other.keys():
             res[key] = other[key]
-
-        res.__idx = 0
-        res.__max = len(res)
         return res
 
     def reset(self):
@@ -266,7 +321,7 @@ class LambdaLayer(Layer):
 class ActivationLayer(Layer):
     def __init__(self, input_shape, activation='relu', layer_name='Activation', **kwargs):
         super(ActivationLayer, self).__init__(input_shape, layer_name)
-        self.activation = utils.function[activation] if not callable(activation) else activation
+        self.activation = utils.get_activation(activation)
         self.kwargs = kwargs
         self.descriptions = '{} Activation layer: {}'.format(self.layer_name, activation)
 
@@ -297,23 +352,32 @@ class DropoutLayer(Layer):
 
         super(DropoutLayer, self).__init__(input_shape, layer_name)
         self.gaussian = gaussian
-        self.srng = theano.sandbox.rng_mrg.MRG_RandomStreams(self.rng.randint(1, int(time.time())))
+        # all dropout layers draw from the module-level stream; a fresh
+        # MRG_RandomStreams per layer would leave one rng state op per layer
+        # in the graph with nothing shared between them
+        self.srng = utils.srng
         self.dropout_prob = drop_prob
         self.position = position
         self.descriptions = '{} Dropout Layer: p={:.2f}'.format(layer_name, 1. - drop_prob)
 
     def get_output(self, input, *args, **kwargs):
-        keep_prob = T.constant((1 - self.dropout_prob) if self.training_flag and not self.gaussian else 1, 'keep_prob',
-                               dtype=theano.config.floatX)
-        if self.training_flag:
-            shape = input.shape if self.position == 'per-activation' else input.shape[:2]
-            mask = self.srng.normal(shape, avg=1.,
-                                    std=np.sqrt(self.dropout_prob / (1. - self.dropout_prob))) if self.gaussian \
-                else self.srng.binomial(n=1, p=keep_prob, size=shape, dtype=theano.config.floatX)
+        # drop_prob is a Python constant, so specialize here instead of leaving
+        # no-op sampling and scaling kernels in the graph
+        if not self.training_flag or self.dropout_prob == 0:
+            return input
+
+        shape = input.shape if self.position == 'per-activation' else input.shape[:2]
+        if self.gaussian:
+            mask = self.srng.normal(shape, avg=1., std=np.sqrt(self.dropout_prob / (1. - self.dropout_prob)))
             if self.position == 'per-channel':
                 mask = mask.dimshuffle(0, 1, 'x', 'x')
-            input = input * mask
-        return input / keep_prob
+            return input * mask
+
+        keep_prob = T.constant(1. - self.dropout_prob, 'keep_prob', dtype=theano.config.floatX)
+        mask = self.srng.binomial(n=1, p=keep_prob, size=shape, dtype=theano.config.floatX)
+        if self.position == 'per-channel':
+            mask = mask.dimshuffle(0, 1, 'x', 'x')
+        return input * mask / keep_prob
 
     @property
     @utils.validate
@@ -342,7 +406,7 @@ class FullyConnectedLayer(Layer):
             raise ValueError('Except for batch dim, all other dims must have non-None values.')
         super(FullyConnectedLayer, self).__init__(in_shape, layer_name)
         self.num_nodes = num_nodes
-        self.activation = utils.function[activation] if not callable(activation) else activation
+        self.activation = utils.get_activation(activation)
         self.no_bias = no_bias
         self.keep_dims = keep_dims
         self.kwargs = kwargs
@@ -441,7 +505,7 @@ class ConvolutionalLayer(Layer):
                                                                                                                tuple)) else (
                 num_filters, input_shape[1], filter_size, filter_size, filter_size)
         self.no_bias = no_bias
-        self.activation = utils.function[activation] if not callable(activation) else activation
+        self.activation = utils.get_activation(activation)
         self.border_mode = border_mode
         self.subsample = tuple(stride) if isinstance(stride, (tuple, list)) else (stride, stride) if len(
             input_shape) == 4 else (stride, stride, stride)
@@ -576,7 +640,7 @@ class PerturbativeLayer(Layer):
         super(PerturbativeLayer, self).__init__(input_shape, layer_name)
         self.num_filters = num_filters
         self.noise_level = noise_level
-        self.activation = utils.function[activation] if not callable(activation) else activation
+        self.activation = utils.get_activation(activation)
         self.no_bias = no_bias
         self.kwargs = kwargs
 
@@ -889,7 +953,7 @@ class TransposedConvolutionalLayer(Layer):
             else (input_shape[1], num_filters, filter_size, filter_size)
         self.padding = padding
         self.stride = stride if isinstance(stride, (list, tuple)) else (stride, stride)
-        self.activation = utils.function[activation] if not callable(activation) else activation
+        self.activation = utils.get_activation(activation)
         self.kwargs = kwargs
         self.output_shape_tmp = (input_shape[0], num_filters, output_shape[0], output_shape[1]) \
             if output_shape is not None \
@@ -1074,7 +1138,7 @@ class ResNetBlock(Sequential):
 
         if self.se_block:
             output = self[self.layer_name + '/se'](output, *args, **kwargs)
-        return utils.function[self.activation](output + res, **self.kwargs)
+        return utils.get_activation(self.activation)(output + res, **self.kwargs)
 
     def reset(self):
         super(ResNetBlock, self).reset()
@@ -1215,7 +1279,7 @@ class NoiseResNetBlock(Layer):
         if self.left_branch:
             for layer in self.shortcut:
                 res = layer(res)
-        return utils.function[self.activation](output + res, **self.kwargs)
+        return utils.get_activation(self.activation)(output + res, **self.kwargs)
 
     @property
     @utils.validate
@@ -1313,7 +1377,7 @@ class RecursiveResNetBlock(Layer):
             output = output[-1]
         else:
             output = input
-        return utils.function[self.activation](output, **self.kwargs)
+        return utils.get_activation(self.activation)(output, **self.kwargs)
 
     @property
     @utils.validate
@@ -1749,7 +1813,7 @@ class Gate:
         self.b = theano.shared(b(hid_shape[0]), layer_name + '/bias')
         self.params.append(self.b)
         self.trainable.append(self.b)
-        self.activation = utils.function[activation] if not callable(activation) else activation
+        self.activation = utils.get_activation(activation)
 
 
 class LSTMCell(Layer):
@@ -1777,7 +1841,7 @@ class LSTMCell(Layer):
         self.learn_init = learn_init
         self.grad_step = grad_step
         self.grad_clip = grad_clip
-        self.activation = utils.function[activation] if not callable(activation) else activation
+        self.activation = utils.get_activation(activation)
         self.kwargs = kwargs
 
         n_in = self.input_shape[-1]
@@ -1991,7 +2055,7 @@ class ConvLSTMCell(Layer):
         self.learn_init = learn_init
         self.grad_step = grad_step
         self.grad_clip = grad_clip
-        self.activation = utils.function[activation] if not callable(activation) else activation
+        self.activation = utils.get_activation(activation)
         self.kwargs = kwargs
 
         n_in = self.input_shape[-1]
@@ -2068,7 +2132,7 @@ class AttConvLSTMCell(Layer):
         self.learn_init = learn_init
         self.grad_step = grad_step
         self.grad_clip = grad_clip
-        self.activation = utils.function[activation] if not callable(activation) else activation
+        self.activation = utils.get_activation(activation)
         self.kwargs = kwargs
 
         self.in_gate = Gate(filter_shape, W_cell=False, layer_name='in_gate')
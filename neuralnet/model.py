@@ -1,4 +1,6 @@
 import abc
+import logging
+
 import numpy
 
 import neuralnet as nn
@@ -14,10 +16,7 @@ class Model(Optimization, Training, layers.NetMethod, metaclass=abc.ABCMeta):
         self.model = layers.Sequential(input_shape=self.input_shape, layer_name=self.config['model']['name'])
 
     def __iter__(self):
-        return self.model.__iter__()
-
-    def __next__(self):
-        return self.model.__next__()
+        return iter(self.model)
 
     def __len__(self):
         return len(self.model)
@@ -55,20 +54,24 @@ class Model(Optimization, Training, layers.NetMethod, metaclass=abc.ABCMeta):
     def regularizable(self):
         return self.model.regularizable
 
+    @property
+    def updates(self):
+        return self.model.updates
+
     def save_learning(self, param_file=None):
         param_file = param_file if param_file else 'opt.npz'
         numpy.savez(param_file, **{p.name: p.get_value() for p in self.opt.accumulations})
-        print('Optimization state dumped to %s' % param_file)
+        logging.info('Optimization state dumped to %s', param_file)
 
     def load_learning(self, param_file=None):
         param_file = param_file if param_file else 'opt.npz'
-        acc = numpy.load(param_file)
+        acc = numpy.load(param_file, allow_pickle=False)
         for p in self.opt.accumulations:
             try:
                 p.set_value(acc[p.name])
             except KeyError:
                 raise KeyError('There is no saved value for %s' % p.name)
-        print('Optimization state loaded from %s' % param_file)
+        logging.info('Optimization state loaded from %s', param_file)
 
     def reset(self):
         self.model.reset()
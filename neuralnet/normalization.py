@@ -1,9 +1,11 @@
 import numpy as np
 import theano
 from theano import tensor as T
+from theano.gpuarray import dnn
 
 from neuralnet import utils
 from neuralnet.layers import *
+from neuralnet.ops import zca_whiten
 
 __all__ = ['BatchNormLayer', 'BatchRenormLayer', 'DecorrBatchNormLayer', 'GroupNormLayer',
            'AdaptiveInstanceNorm2DLayer', 'InstanceNormLayer', 'LayerNormLayer', 'AdaIN2DLayer',
@@ -24,21 +26,25 @@ class BatchNormLayer(Layer):
         super(BatchNormLayer, self).__init__(input_shape, layer_name)
         self.epsilon = np.float32(epsilon)
         self.running_average_factor = running_average_factor
-        self.activation = utils.function[activation] if not callable(activation) else activation
+        self.activation = utils.get_activation(activation)
         self.no_scale = no_scale
         self.axes = (0,) + tuple(range(2, len(input_shape))) if axes == 'spatial' else (0,)
         self.shape = (self.input_shape[1],) if axes == 'spatial' else self.input_shape[1:]
+        self.mode = 'spatial' if axes == 'spatial' else 'per-activation'
+        self._use_dnn = len(input_shape) == 4 and 'cuda' in theano.config.device and dnn.dnn_present()
+        # storage dtype of the running stats; accumulation stays in floatX
+        self.stats_dtype = kwargs.pop('stats_dtype', theano.config.floatX)
         self.kwargs = kwargs
 
         self.gamma_values = np.ones(self.shape, dtype=theano.config.floatX)
-        self.gamma = theano.shared(np.copy(self.gamma_values), name=layer_name + '/gamma', borrow=True)
+        self.gamma = theano.shared(self.gamma_values, name=layer_name + '/gamma')
 
         self.beta_values = np.zeros(self.shape, dtype=theano.config.floatX)
-        self.beta = theano.shared(np.copy(self.beta_values), name=layer_name + '/beta', borrow=True)
+        self.beta = theano.shared(self.beta_values, name=layer_name + '/beta')
 
-        self.running_mean = theano.shared(np.zeros(self.shape, dtype=theano.config.floatX),
+        self.running_mean = theano.shared(np.zeros(self.shape, dtype=self.stats_dtype),
                                           name=layer_name + '/running_mean', borrow=True)
-        self.running_var = theano.shared(np.zeros(self.shape, dtype=theano.config.floatX),
+        self.running_var = theano.shared(np.zeros(self.shape, dtype=self.stats_dtype),
                                          name=layer_name + '/running_var', borrow=True)
 
         self.params += [self.running_mean, self.running_var, self.gamma, self.beta]
@@ -54,24 +60,57 @@ class BatchNormLayer(Layer):
         self.descriptions = '{} Batch Norm Layer: {} -> {} running_average_factor = {:.4f} activation: {}' \
             .format(layer_name, self.input_shape, self.output_shape, self.running_average_factor, activation)
 
+    def _param_pattern(self, input):
+        """broadcast pattern to align the per-channel parameters with the input"""
+        param_axes = iter(range(input.ndim - len(self.axes)))
+        return ['x' if i in self.axes else next(param_axes) for i in range(input.ndim)]
+
+    def _running_stats(self):
+        """running stats upcast to floatX for accumulation when stored in a narrower dtype"""
+        if self.stats_dtype == theano.config.floatX:
+            return self.running_mean, self.running_var
+        return T.cast(self.running_mean, theano.config.floatX), T.cast(self.running_var, theano.config.floatX)
+
     def batch_normalization_train(self, input):
-        out, _, _, mean_, var_ = T.nnet.bn.batch_normalization_train(input, self.gamma, self.beta, self.axes,
-                                                                     self.epsilon, self.running_average_factor,
-                                                                     self.running_mean, self.running_var)
-
-        # Update running mean and variance
-        # Tricks adopted from Lasagne implementation
-        # http://lasagne.readthedocs.io/en/latest/modules/layers/normalization.html
-        running_mean = theano.clone(self.running_mean, share_inputs=False)
-        running_var = theano.clone(self.running_var, share_inputs=False)
-        running_mean.default_update = mean_
-        running_var.default_update = var_
-        out += 0 * (running_mean + running_var)
+        running_mean, running_var = self._running_stats()
+        if self._use_dnn and input.ndim == 4:
+            # cuDNN fuses the mean/var reductions, normalization and scale/shift into one kernel
+            pattern = self._param_pattern(input)
+            out, _, _, mean_, var_ = dnn.dnn_batch_normalization_train(input, self.gamma.dimshuffle(pattern),
+                                                                       self.beta.dimshuffle(pattern), self.mode,
+                                                                       self.epsilon, self.running_average_factor,
+                                                                       running_mean.dimshuffle(pattern),
+                                                                       running_var.dimshuffle(pattern))
+            mean_ = T.reshape(mean_, self.running_mean.shape)
+            var_ = T.reshape(var_, self.running_var.shape)
+        else:
+            out, _, _, mean_, var_ = T.nnet.bn.batch_normalization_train(input, self.gamma, self.beta, self.axes,
+                                                                         self.epsilon, self.running_average_factor,
+                                                                         running_mean, running_var)
+
+        # Stash the running average updates so the caller can collect them via
+        # layer/model updates and pass them to theano.function. The former
+        # Lasagne default_update trick required cloning the stats and adding
+        # dummy arithmetic to the forward graph to force the updates to fire.
+        self._updates[self.running_mean] = T.cast(mean_, self.stats_dtype)
+        self._updates[self.running_var] = T.cast(var_, self.stats_dtype)
         return out
 
     def batch_normalization_test(self, input):
-        out = T.nnet.bn.batch_normalization_test(input, self.gamma, self.beta, self.running_mean, self.running_var,
-                                                 axes=self.axes, epsilon=self.epsilon)
+        running_mean, running_var = self._running_stats()
+        if self._use_dnn and input.ndim == 4:
+            pattern = self._param_pattern(input)
+            out = dnn.dnn_batch_normalization_test(input, self.gamma.dimshuffle(pattern),
+                                                   self.beta.dimshuffle(pattern),
+                                                   running_mean.dimshuffle(pattern),
+                                                   running_var.dimshuffle(pattern), self.mode, self.epsilon)
+        else:
+            # fold gamma and the running std into one per-channel scale so the
+            # feature map is touched by a single scale-and-shift pass
+            pattern = self._param_pattern(input)
+            inv = self.gamma / T.sqrt(running_var + self.epsilon)
+            shift = self.beta - running_mean * inv
+            out = input * inv.dimshuffle(pattern) + shift.dimshuffle(pattern)
         return out
 
     def get_output(self, input, *args, **kwargs):
@@ -84,8 +123,8 @@ class BatchNormLayer(Layer):
         return tuple(self.input_shape)
 
     def reset(self):
-        self.gamma.set_value(np.copy(self.gamma_values))
-        self.beta.set_value(np.copy(self.beta_values))
+        self.gamma.set_value(self.gamma_values)
+        self.beta.set_value(self.beta_values)
         if self.activation is utils.function['prelu']:
             self.alpha.set_value(np.float32(.1))
 
@@ -113,17 +152,11 @@ class DecorrBatchNormLayer(BatchNormLayer):
             layer_name, self.input_shape, self.output_shape, self.running_average_factor, activation)
 
     def get_output(self, input, *args, **kwargs):
-        eigh = T.nlinalg.Eigh()
         m, c, h, w = T.shape(input)
 
         X = input.dimshuffle((1, 0, 2, 3))
         X = X.flatten(2)
-        Muy = T.mean(X, axis=1)
-        X_centered = X - Muy
-        Sigma = 1. / m * T.dot(X_centered, X_centered.T)
-        W, D = eigh(Sigma)
-        Z = T.dot(T.dot(D, T.nlinalg.diag(T.sqrt(W))), D.T)
-        X = T.dot(Z, X)
+        X = zca_whiten(X, m)
         out = self.activation(self.batch_normalization_train(X.T) if self.training_flag
                               else self.batch_normalization_test(X.T), **self.kwargs)
         out = T.reshape(out.T, (c, m, h, w))
@@ -144,13 +177,17 @@ class GroupNormLayer(Layer):
         super(GroupNormLayer, self).__init__(tuple(input_shape), layer_name)
         self.groups = groups
         self.epsilon = np.float32(epsilon)
-        self.activation = utils.function[activation] if not callable(activation) else activation
+        self.activation = utils.get_activation(activation)
         self.kwargs = kwargs
         self.gamma_values = np.ones(self.input_shape[1], dtype=theano.config.floatX)
-        self.gamma = theano.shared(np.copy(self.gamma_values), name=layer_name + '/gamma', borrow=True)
+        self.gamma = theano.shared(self.gamma_values, name=layer_name + '/gamma')
 
         self.beta_values = np.zeros(self.input_shape[1], dtype=theano.config.floatX)
-        self.beta = theano.shared(np.copy(self.beta_values), name=layer_name + '/beta', borrow=True)
+        self.beta = theano.shared(self.beta_values, name=layer_name + '/beta')
+
+        # broadcast-ready views built once here instead of two dimshuffle nodes per forward call
+        self._gamma_bc = self.gamma.dimshuffle('x', 0, 'x', 'x')
+        self._beta_bc = self.beta.dimshuffle('x', 0, 'x', 'x')
 
         self.params += [self.gamma, self.beta]
         self.trainable += [self.gamma, self.beta]
@@ -166,27 +203,13 @@ class GroupNormLayer(Layer):
             .format(layer_name, self.input_shape, self.output_shape, activation)
 
     def get_output(self, input, *args, **kwargs):
-        gamma = self.gamma.dimshuffle('x', 0, 'x', 'x')
-        beta = self.beta.dimshuffle('x', 0, 'x', 'x')
-        if self.groups == 1:
-            input_ = input.dimshuffle(1, 0, 2, 3)
-            ones = T.ones_like(T.mean(input_, (0, 2, 3), keepdims=True), theano.config.floatX)
-            zeros = T.zeros_like(T.mean(input_, (0, 2, 3), keepdims=True), theano.config.floatX)
-            output, _, _ = T.nnet.bn.batch_normalization_train(input_, ones, zeros, 'spatial', self.epsilon)
-            output = gamma * output.dimshuffle(1, 0, 2, 3) + beta
-        elif self.groups == self.input_shape[1]:
-            ones = T.ones_like(T.mean(input, (2, 3), keepdims=True), theano.config.floatX)
-            zeros = T.zeros_like(T.mean(input, (2, 3), keepdims=True), theano.config.floatX)
-            output, _, _ = T.nnet.bn.batch_normalization_train(input, ones, zeros, (2, 3))
-            output = gamma * output + beta
-        else:
-            n, c, h, w = T.shape(input)
-            input_ = T.reshape(input, (n, self.groups, -1, h, w))
-            mean = T.mean(input_, (2, 3, 4), keepdims=True)
-            var = T.var(input_, (2, 3, 4), keepdims=True)
-            input_ = (input_ - mean) / T.sqrt(var + self.epsilon)
-            input_ = T.reshape(input_, (n, c, h, w))
-            output = gamma * input_ + beta
+        n, c, h, w = T.shape(input)
+        input_ = T.reshape(input, (n, self.groups, -1, h, w))
+        mean = T.mean(input_, (2, 3, 4), keepdims=True)
+        var = T.mean(T.sqr(input_), (2, 3, 4), keepdims=True) - T.sqr(mean)
+        input_ = (input_ - mean) * T.inv(T.sqrt(var + self.epsilon))
+        input_ = T.reshape(input_, (n, c, h, w))
+        output = self._gamma_bc * input_ + self._beta_bc
         return self.activation(output, **self.kwargs)
 
     @property
@@ -195,8 +218,8 @@ class GroupNormLayer(Layer):
         return tuple(self.input_shape)
 
     def reset(self):
-        self.gamma.set_value(np.copy(self.gamma_values))
-        self.beta.set_value(np.copy(self.beta_values))
+        self.gamma.set_value(self.gamma_values)
+        self.beta.set_value(self.beta_values)
         if self.activation is utils.function['prelu']:
             self.alpha.set_value(np.float32(.1))
 
@@ -222,23 +245,23 @@ class BatchRenormLayer(BatchNormLayer):
                                                                                                      self.running_average_factor)
 
     def get_output(self, input, *args, **kwargs):
+        running_mean, running_var = self._running_stats()
         batch_mean = T.mean(input, axis=self.axes)
-        batch_std = T.sqrt(T.var(input, axis=self.axes) + 1e-10)
-        r = T.clip(batch_std / T.sqrt(self.running_var + 1e-10), -self.r_max, self.r_max)
-        d = T.clip((batch_mean - self.running_mean) / T.sqrt(self.running_var + 1e-10), -self.d_max, self.d_max)
+        batch_var = T.mean(T.sqr(input), axis=self.axes) - T.sqr(batch_mean)
+        batch_std = T.sqrt(batch_var + 1e-10)
+        r = T.clip(batch_std / T.sqrt(running_var + 1e-10), -self.r_max, self.r_max)
+        d = T.clip((batch_mean - running_mean) / T.sqrt(running_var + 1e-10), -self.d_max, self.d_max)
         out = T.nnet.bn.batch_normalization_test(input, self.gamma, self.beta, batch_mean - d * batch_std / (r + 1e-10),
                                                  T.sqr(batch_std / (r + 1e-10)), axes=self.axes, epsilon=self.epsilon)
         if self.training_flag:
-            # Update running mean and variance
-            # Tricks adopted from Lasagne implementation
-            # http://lasagne.readthedocs.io/en/latest/modules/layers/normalization.html
+            # Stash the running average updates for the caller to pass to
+            # theano.function instead of the Lasagne default_update trick
             m = T.cast(T.prod(input.shape) / T.prod(self.gamma.shape), theano.config.floatX)
-            running_mean = theano.clone(self.running_mean, share_inputs=False)
-            running_var = theano.clone(self.running_var, share_inputs=False)
-            running_mean.default_update = running_mean + self.running_average_factor * (batch_mean - running_mean)
-            running_var.default_update = running_var * (1. - self.running_average_factor) + \
-                                         self.running_average_factor * (m / (m - 1)) * T.sqr(batch_std)
-            out += 0 * (running_mean + running_var)
+            self._updates[self.running_mean] = T.cast(running_mean + self.running_average_factor *
+                                                     (batch_mean - running_mean), self.stats_dtype)
+            self._updates[self.running_var] = T.cast(running_var * (1. - self.running_average_factor) +
+                                                    self.running_average_factor * (m / (m - 1)) * T.sqr(batch_std),
+                                                    self.stats_dtype)
         return self.activation(out)
 
 
@@ -254,12 +277,17 @@ class AdaptiveInstanceNorm2DLayer(Layer):
             'The second element in input should either be a feature map or a concatenated matrix.'
 
         if params.ndim == 4:
-            scale, bias = T.sqrt(T.var(params, (2, 3)) + 1e-8), T.mean(params, (2, 3))
+            bias = T.mean(params, (2, 3), keepdims=True)
+            p_var = T.mean(T.sqr(params), (2, 3), keepdims=True) - T.sqr(bias)
+            scale = T.sqrt(p_var + 1e-8)
         else:
             scale = params[:, :self.input_shape[1]].dimshuffle(0, 1, 'x', 'x')
             bias = params[:, self.input_shape[1]:].dimshuffle(0, 1, 'x', 'x')
-        output, _, _ = T.nnet.bn.batch_normalization_train(input, scale, bias, (2, 3))
-        return output
+        x_mean = T.mean(input, (2, 3), keepdims=True)
+        x_var = T.mean(T.sqr(input), (2, 3), keepdims=True) - T.sqr(x_mean)
+        # scale / std is a per-instance-channel vector, so the feature map is
+        # touched by a single scale-and-shift pass
+        return (input - x_mean) * (scale * T.inv(T.sqrt(x_var + self.epsilon))) + bias
 
     @property
     @utils.validate
@@ -284,8 +312,9 @@ class ConditionalInstanceNorm2DLayer(AdaptiveInstanceNorm2DLayer):
     def get_output(self, input, noise, *args, **kwargs):
         shift = T.addbroadcast(self.shift_conv(noise.dimshuffle(0, 1, 'x', 'x')), 2, 3)
         scale = T.addbroadcast(self.scale_conv(noise.dimshuffle(0, 1, 'x', 'x')), 2, 3)
-        mean, std = T.mean(input, (2, 3), keepdims=True), T.sqrt(T.var(input, (2, 3), keepdims=True) + self.epsilon)
-        normed = (input - mean) / std
+        mean = T.mean(input, (2, 3), keepdims=True)
+        var = T.mean(T.sqr(input), (2, 3), keepdims=True) - T.sqr(mean)
+        normed = (input - mean) / T.sqrt(var + self.epsilon)
         return normed * scale + shift
 
 
@@ -298,9 +327,24 @@ class InstanceNormLayer(GroupNormLayer):
         self.descriptions = '{} Instance Norm Layer: shape: {} -> {} activation: {}' \
             .format(layer_name, self.input_shape, self.output_shape, activation)
 
+    def get_output(self, input, *args, **kwargs):
+        # groups == C specialization: reduce straight over the spatial axes
+        # without the grouped reshape
+        mean = T.mean(input, (2, 3), keepdims=True)
+        var = T.mean(T.sqr(input), (2, 3), keepdims=True) - T.sqr(mean)
+        output = (input - mean) * T.inv(T.sqrt(var + self.epsilon))
+        return self.activation(output * self._gamma_bc + self._beta_bc, **self.kwargs)
+
 
 class LayerNormLayer(GroupNormLayer):
     def __init__(self, input_shape, layer_name='LN', epsilon=1e-4, activation='relu', **kwargs):
         super(LayerNormLayer, self).__init__(input_shape, layer_name, 1, epsilon, activation, **kwargs)
         self.descriptions = '{} Layer Norm Layer: shape: {} -> {} activation: {}' \
             .format(layer_name, self.input_shape, self.output_shape, activation)
+
+    def get_output(self, input, *args, **kwargs):
+        # groups == 1 specialization: one reduction over all feature axes
+        mean = T.mean(input, (1, 2, 3), keepdims=True)
+        var = T.mean(T.sqr(input), (1, 2, 3), keepdims=True) - T.sqr(mean)
+        output = (input - mean) * T.inv(T.sqrt(var + self.epsilon))
+        return self.activation(output * self._gamma_bc + self._beta_bc, **self.kwargs)
@@ -0,0 +1,25 @@
+import theano
+from theano import tensor as T
+
+__all__ = ['zca_whiten']
+
+
+def zca_whiten(x, normalizer):
+    """
+    Whiten the rows of a (features, samples) matrix by the eigendecomposition
+    of its covariance. The covariance is computed by a single GEMM and the
+    whitening transform is applied in one op call so no intermediate feature
+    map is materialized between the statistics and the transform.
+
+    :param x: a 2D tensor of shape (features, samples)
+    :param normalizer: the number of samples the covariance is averaged over
+    :return: the whitened version of x
+    """
+    mu = T.mean(x, 1, keepdims=True)
+    x_centered = x - mu
+    sigma = T.dot(x_centered, x_centered.T) / T.cast(normalizer, theano.config.floatX)
+    w, d = T.nlinalg.Eigh()(sigma)
+    # scale the eigenvector columns instead of multiplying by diag(sqrt(w)),
+    # and apply the transform right-to-left so the dense (C, C) whitening
+    # matrix is never materialized
+    return T.dot(d * T.sqrt(w).dimshuffle('x', 0), T.dot(d.T, x))
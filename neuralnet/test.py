@@ -816,3 +816,82 @@ def test_lstm_dnn():
     out = func(x_val)
     print(out.shape)
     print(out)
+
+
+def test_maxout_np():
+    size = 4
+    x = np.random.rand(3, 8, 5, 5).astype(theano.config.floatX)
+
+    out = nn.utils.maxout(x, maxout_size=size)
+    assert isinstance(out, np.ndarray)
+    utt.assert_allclose(out, np.maximum.reduce([x[:, i::size] for i in range(size)]))
+
+    sym = nn.utils.maxout(T.as_tensor(x), maxout_size=size)
+    utt.assert_allclose(sym.eval(), out)
+
+    x2d = np.random.rand(3, 12).astype(theano.config.floatX)
+    out2d = nn.utils.maxout(x2d, maxout_size=size)
+    utt.assert_allclose(out2d, np.maximum.reduce([x2d[:, i::size] for i in range(size)]))
+
+
+def test_unpool_np():
+    x = np.random.rand(2, 3, 4, 5).astype(theano.config.floatX)
+
+    out = nn.utils.unpool(x, (2, 3))
+    assert isinstance(out, np.ndarray)
+    utt.assert_allclose(out, x.repeat(2, 2).repeat(3, 3))
+
+    sym = nn.utils.unpool(T.as_tensor(x), (2, 3))
+    utt.assert_allclose(sym.eval(), out)
+
+    utt.assert_allclose(nn.utils.unpool(x, 2), x.repeat(2, 2).repeat(2, 3))
+
+
+def test_rgb2gray_np():
+    img = np.random.rand(2, 3, 8, 8).astype(theano.config.floatX)
+
+    out = nn.utils.rgb2gray(img)
+    assert isinstance(out, np.ndarray)
+    assert out.shape == (2, 1, 8, 8)
+    utt.assert_allclose(out[:, 0], .299 * img[:, 0] + .587 * img[:, 1] + .114 * img[:, 2], rtol=1e-5)
+
+
+def test_generate_in_background():
+    dm = nn.DataManager(batch_size=2, n_epochs=1, num_cached=3)
+    batches = [[np.random.rand(2, 3).astype(theano.config.floatX), np.arange(i, i + 2, dtype='int32')]
+               for i in range(7)]
+
+    got = []
+    for batch in dm.generate_in_background(iter([list(b) for b in batches])):
+        # slots are recycled once the consumer resumes, so copy before advancing
+        got.append([np.array(a) for a in batch])
+    assert len(got) == len(batches)
+    for g, e in zip(got, batches):
+        utt.assert_allclose(g[0], e[0])
+        utt.assert_allclose(g[1], e[1])
+
+    arrays = [np.random.rand(2, 3).astype(theano.config.floatX) for _ in range(7)]
+    got = [np.array(a) for a in dm.generate_in_background(iter(arrays))]
+    for g, e in zip(got, arrays):
+        utt.assert_allclose(g, e)
+
+    # a partial final batch does not fit the ring buffers and passes through unstaged
+    ragged = [np.random.rand(2, 3).astype(theano.config.floatX) for _ in range(4)]
+    ragged.append(np.random.rand(1, 3).astype(theano.config.floatX))
+    got = [np.array(a) for a in dm.generate_in_background(iter(ragged))]
+    assert [g.shape for g in got] == [e.shape for e in ragged]
+    for g, e in zip(got, ragged):
+        utt.assert_allclose(g, e)
+
+    # a crash in the source generator is re-raised in the consumer instead of hanging it
+    def broken():
+        yield np.random.rand(2, 3).astype(theano.config.floatX)
+        raise RuntimeError('source generator died')
+
+    try:
+        for _ in dm.generate_in_background(broken()):
+            pass
+    except RuntimeError as e:
+        assert 'source generator died' in str(e)
+    else:
+        raise AssertionError('producer failure was swallowed')
@@ -1,12 +1,17 @@
 import abc
+import copy
 import json
 import logging
+import os
 import pickle as pkl
 import sys
 import threading
 import time
-from functools import reduce
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, reduce
+from itertools import chain
 from queue import Queue
+from types import MappingProxyType
 
 import cloudpickle as cpkl
 import numpy as np
@@ -19,6 +24,28 @@ from theano.gpuarray.dnn import dnn_pool as pool
 from neuralnet import __version__
 
 __all__ = ['ConfigParser', 'DataManager', 'placeholder']
+
+try:
+    import cv2
+
+    def _resize(image, size):
+        return cv2.resize(image, (size[1], size[0]), interpolation=cv2.INTER_LINEAR)
+except ImportError:
+    try:
+        from PIL import Image
+
+        def _resize(image, size):
+            return np.asarray(Image.fromarray(image).resize((size[1], size[0]), Image.BILINEAR))
+    except ImportError:
+        def _resize(image, size):
+            return misc.imresize(image, size)
+
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
 thread_lock = threading.Lock()
 srng = theano.sandbox.rng_mrg.MRG_RandomStreams(np.random.RandomState(int(time.time())).randint(1, int(time.time())))
 
@@ -52,18 +79,23 @@ def deprecated(version=None, message=None):
     return deprecated_decorator
 
 
-class Thread(threading.Thread):
-    def __init__(self, id, name, func):
-        threading.Thread.__init__(self)
-        self.id = id
-        self.name = name
-        self.func = func
+def run_parallel(funcs):
+    """
+    Runs the given argument-less callables concurrently and returns their results
+    in order. Theano functions release the GIL while their C/BLAS code runs, so
+    the callables genuinely overlap; a section that really must be serialized
+    (e.g. weight file I/O) should take thread_lock inside the callable instead
+    of wrapping the whole call.
+    """
+    with ThreadPoolExecutor(max_workers=len(funcs)) as executor:
+        return [future.result() for future in [executor.submit(func) for func in funcs]]
+
 
-    def run(self):
-        print('Starting ' + self.name)
-        thread_lock.acquire()
-        self.outputs = self.func()
-        thread_lock.release()
+@lru_cache(maxsize=32)
+def _load_config(config_file, mtime):
+    # keyed by (file, mtime) so repeat loads of an unchanged config are free
+    with open(config_file, 'rb') as f:
+        return _json_loads(f.read())
 
 
 class ConfigParser:
@@ -77,12 +109,13 @@ class ConfigParser:
 
     def load_configuration(self):
         try:
-            with open(self.config_file) as f:
-                data = json.load(f)
-            print('Config file loaded successfully')
-        except:
-            raise NameError('Unable to open config file!!!')
-        return data
+            data = _load_config(self.config_file, os.path.getmtime(self.config_file))
+        except (OSError, ValueError) as e:
+            raise RuntimeError('Unable to open config file %s' % self.config_file) from e
+        logging.info('Config file loaded successfully')
+        # callers mutate their config (DataManager pops batch_size/n_epochs),
+        # so hand out a copy instead of the cached dict
+        return copy.deepcopy(data)
 
 
 class DataManager(ConfigParser, metaclass=abc.ABCMeta):
@@ -120,6 +153,8 @@ class DataManager(ConfigParser, metaclass=abc.ABCMeta):
         self.data_size = None
         self.placeholders = placeholders
         self.batches = None
+        self._rng = np.random.default_rng()
+        self._placeholder_shape = None
 
     @classmethod
     def load_data(self):
@@ -192,16 +227,55 @@ class DataManager(ConfigParser, metaclass=abc.ABCMeta):
 
     def generate_in_background(self, generator):
         """
-        Runs a generator in a background thread, caching up to `num_cached` items.
+        Runs a generator in a background thread, staging batches into a ring of
+        `num_cached` pre-allocated host buffers. The producer writes each batch
+        into a free slot and only slot indices travel through the queues, so no
+        per-batch allocation happens and the consumer always hands Theano the
+        same host memory. A slot is recycled once the consumer is resumed,
+        which is after its content has been copied to the placeholders.
+        Batches that do not match the ring buffers (e.g. a partial final batch)
+        are passed through unstaged, and a crash in the producer is re-raised
+        here instead of hanging the consumer.
         """
-        queue = Queue(maxsize=self.num_cached)
+        first = next(generator, None)
+        if first is None:
+            return
+
+        arrays = (first,) if isinstance(first, np.ndarray) else tuple(first) if isinstance(first,
+                                                                                           (list, tuple)) else None
+        staged = arrays is not None and all(isinstance(a, np.ndarray) for a in arrays)
+        ring = [[np.empty_like(a) for a in arrays] for _ in range(self.num_cached)] if staged else None
+        free = Queue()
+        ready = Queue(maxsize=self.num_cached)
+        if staged:
+            for i in range(self.num_cached):
+                free.put(i)
+
+        def _stageable(item):
+            if not staged or not isinstance(item, (np.ndarray, list, tuple)):
+                return None
+            batch = (item,) if isinstance(item, np.ndarray) else tuple(item)
+            if len(batch) == len(ring[0]) and all(
+                    isinstance(a, np.ndarray) and buf.shape == a.shape for buf, a in zip(ring[0], batch)):
+                return batch
+            return None
 
         # define producer (putting items into queue)
         def producer():
-            for item in generator:
-                queue.put(item)
-            queue.join()
-            queue.put(None)
+            try:
+                for item in chain((first,), generator):
+                    batch = _stageable(item)
+                    if batch is not None:
+                        idx = free.get()
+                        for buf, a in zip(ring[idx], batch):
+                            np.copyto(buf, a)
+                        ready.put(('slot', idx))
+                    else:
+                        ready.put(('item', item))
+            except BaseException as e:
+                ready.put(('error', e))
+            else:
+                ready.put(None)
 
         # start producer (in a background thread)
         thread = threading.Thread(target=producer)
@@ -210,11 +284,17 @@ class DataManager(ConfigParser, metaclass=abc.ABCMeta):
 
         # run as consumer (read items from queue, in current thread)
         while True:
-            item = queue.get()
-            if item is None:
+            msg = ready.get()
+            if msg is None:
                 break
-            yield item
-            queue.task_done()
+            kind, payload = msg
+            if kind == 'error':
+                raise payload
+            if kind == 'slot':
+                yield ring[payload][0] if isinstance(first, np.ndarray) else list(ring[payload])
+                free.put(payload)
+            else:
+                yield payload
 
     def update_input(self, data):
         if self.placeholders is not None:
@@ -225,11 +305,15 @@ class DataManager(ConfigParser, metaclass=abc.ABCMeta):
                     p.set_value(d, borrow=True)
             elif isinstance(self.placeholders, theano.gpuarray.type.GpuArraySharedVariable) and isinstance(data,
                                                                                                            np.ndarray):
-                x = data
-                shape_x = self.placeholders.get_value().shape
-                if x.shape != shape_x:
-                    raise ValueError('Shape mismatch. Got {} for shared variable of shape {}.'.format(x.shape, shape_x))
-                self.placeholders.set_value(x, borrow=True)
+                if self._placeholder_shape is None:
+                    # borrow/return_internal_type reads the shape without a
+                    # device-to-host copy; cached since set_value keeps it fixed
+                    self._placeholder_shape = self.placeholders.get_value(borrow=True,
+                                                                          return_internal_type=True).shape
+                if data.shape != self._placeholder_shape:
+                    raise ValueError('Shape mismatch. Got {} for shared variable of shape {}.'
+                                     .format(data.shape, self._placeholder_shape))
+                self.placeholders.set_value(data, borrow=True)
             else:
                 raise TypeError(
                     'placeholders should be a theano shared or list/tuple type and data should be a list, '
@@ -237,14 +321,13 @@ class DataManager(ConfigParser, metaclass=abc.ABCMeta):
 
     def generator(self):
         num_batches = self.data_size // self.batch_size
-        dataset = list(self.dataset) if isinstance(self.dataset, (list, tuple)) else np.copy(self.dataset)
+        dataset = self.dataset
         if self.shuffle:
-            index = np.arange(0, self.data_size)
-            np.random.shuffle(index)
+            index = self._rng.permutation(self.data_size)
             if isinstance(self.dataset, (list, tuple)):
                 assert all(isinstance(data, np.ndarray) for data in self.dataset), 'All objects in dataset should ' \
                                                                                    'be numpy ndarray objects.'
-                dataset = tuple([x[index] for x in self.dataset])
+                dataset = tuple(x[index] for x in self.dataset)
             elif isinstance(self.dataset, np.ndarray):
                 dataset = self.dataset[index]
             else:
@@ -290,7 +373,7 @@ def crop_center(image, crop, resize=None):
             newh, neww = resize, int(scale * w + 0.5)
         else:
             newh, neww = int(scale * h + 0.5), resize
-        image = misc.imresize(image, (newh, neww))
+        image = _resize(image, (newh, neww))
 
     orig_shape = image.shape
     h0 = int((orig_shape[0] - crop[0]) * 0.5)
@@ -308,7 +391,7 @@ def crop_random(image, crop, resize=None):
             newh, neww = resize, int(scale * w + 0.5)
         else:
             newh, neww = int(scale * h + 0.5), resize
-        image = misc.imresize(image, (newh, neww))
+        image = _resize(image, (newh, neww))
 
     def _get_params():
         h, w = image.shape[:2]
@@ -430,14 +513,11 @@ def convert_dense_weights_data_format(weights, previous_feature_map_shape, targe
 
 def maxout(input, **kwargs):
     size = kwargs.get('maxout_size', 4)
-    maxout_out = None
-    for i in range(size):
-        t = input[:, i::size]
-        if maxout_out is None:
-            maxout_out = t
-        else:
-            maxout_out = T.maximum(maxout_out, t)
-    return maxout_out
+    shape = input.shape
+    new_shape = (shape[0], shape[1] // size, size) + tuple(shape[i] for i in range(2, input.ndim))
+    if isinstance(input, np.ndarray):
+        return np.max(np.reshape(input, new_shape), axis=2)
+    return T.max(T.reshape(input, new_shape, ndim=input.ndim + 1), axis=2)
 
 
 def lrelu(x, **kwargs):
@@ -446,8 +526,7 @@ def lrelu(x, **kwargs):
 
 
 def ramp(x, **kwargs):
-    left = T.switch(x < 0, 0, x)
-    return T.switch(left > 1, 1, left)
+    return T.clip(x, 0., 1.)
 
 
 def prelu(x, **kwargs):
@@ -474,12 +553,53 @@ def inference(input, model):
     return feed
 
 
-def rgb2gray(img):
+def rgb2gray_sym(img):
     if img.ndim != 4:
         raise ValueError('Input images must have four dimensions, not %d' % img.ndim)
     return (0.299 * img[:, 0] + 0.587 * img[:, 1] + 0.114 * img[:, 2]).dimshuffle((0, 'x', 1, 2))
 
 
+try:
+    import numba
+
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def _rgb2gray_np(img, out):
+        num, _, height, width = img.shape
+        for n in numba.prange(num):
+            for h in range(height):
+                for w in range(width):
+                    out[n, 0, h, w] = .299 * img[n, 0, h, w] + .587 * img[n, 1, h, w] + .114 * img[n, 2, h, w]
+
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def _unpool_np(x, sh, sw, out):
+        num, chan, height, width = x.shape
+        for n in numba.prange(num):
+            for c in range(chan):
+                for i in range(height):
+                    for j in range(width):
+                        v = x[n, c, i, j]
+                        for a in range(sh):
+                            for b in range(sw):
+                                out[n, c, i * sh + a, j * sw + b] = v
+except ImportError:
+    def _rgb2gray_np(img, out):
+        out[:, 0] = .299 * img[:, 0] + .587 * img[:, 1] + .114 * img[:, 2]
+
+    def _unpool_np(x, sh, sw, out):
+        out[:] = x.repeat(sh, 2).repeat(sw, 3)
+
+
+def rgb2gray(img):
+    if isinstance(img, np.ndarray):
+        if img.ndim != 4:
+            raise ValueError('Input images must have four dimensions, not %d' % img.ndim)
+        out = np.empty((img.shape[0], 1) + img.shape[2:],
+                       img.dtype if img.dtype.kind == 'f' else theano.config.floatX)
+        _rgb2gray_np(img, out)
+        return out
+    return rgb2gray_sym(img)
+
+
 def rgb2ycbcr(img):
     if img.ndim != 4:
         raise ValueError('Input images must have four dimensions, not %d' % img.ndim)
@@ -957,16 +1077,24 @@ def unpool(input, shape):
     assert isinstance(shape, (list, tuple, int)), 'shape must be a list, tuple, or int, got %s' % type(shape)
 
     shape = tuple(shape) if isinstance(shape, (list, tuple)) else (shape, shape)
-    output = T.repeat(input, shape[0], 2)
-    output = T.repeat(output, shape[1], 3)
-    return output
+    if isinstance(input, np.ndarray):
+        n, c, h, w = input.shape
+        out = np.empty((n, c, h * shape[0], w * shape[1]), input.dtype)
+        _unpool_np(input, shape[0], shape[1], out)
+        return out
+
+    n, c, h, w = input.shape
+    # broadcast against inserted axes and collapse them, so only the final
+    # upsampled tensor is materialized instead of one intermediate per repeat
+    output = T.tile(input.dimshuffle(0, 1, 2, 'x', 3, 'x'), (1, 1, 1, shape[0], 1, shape[1]))
+    return T.reshape(output, (n, c, h * shape[0], w * shape[1]))
 
 
 def batch_set_value(tuples):
     for x, value in tuples:
-        if x.get_value().shape != value.shape:
+        if x.get_value(borrow=True, return_internal_type=True).shape != np.shape(value):
             raise ValueError('Dimension mismatch for %s.' % x.name)
-        x.set_value(np.asarray(value, dtype=x.dtype))
+        x.set_value(np.ascontiguousarray(value, dtype=x.dtype), borrow=True)
 
 
 def make_tensor_kernel_from_numpy(kern_shape, numpy_kernel, type='each'):
@@ -1193,7 +1321,7 @@ def make_one_hot(label, dim):
 def placeholder(shape=None, dtype=theano.config.floatX, value=None, name=None, borrow=None):
     assert shape is not None or value is not None, 'Either \'shape\' or \'value\' must be provided.'
     if value is not None:
-        x = theano.shared(np.cast[dtype](value), name, borrow=borrow)
+        x = theano.shared(np.asarray(value, dtype=dtype), name, borrow=borrow)
     else:
         x = theano.shared(np.zeros(shape, dtype), name, borrow=borrow)
     return x
@@ -1379,8 +1507,29 @@ def scatter_nd(indices, updates, shape):
     return out
 
 
-function = {'relu': lambda x, **kwargs: T.nnet.relu(x), 'sigmoid': lambda x, **kwargs: T.nnet.sigmoid(x),
-            'tanh': lambda x, **kwargs: T.tanh(x), 'lrelu': lrelu, 'softmax': lambda x, **kwargs: T.nnet.softmax(x),
-            'linear': lambda x, **kwargs: x, 'elu': lambda x, **kwargs: T.nnet.elu(x), 'ramp': ramp, 'maxout': maxout,
-            'sin': lambda x, **kwargs: T.sin(x), 'cos': lambda x, **kwargs: T.cos(x), 'swish': swish, 'selu': selu,
-            'prelu': prelu, None: lambda x, **kwargs: x}
+function = MappingProxyType(
+    {'relu': lambda x, **kwargs: T.nnet.relu(x), 'sigmoid': lambda x, **kwargs: T.nnet.sigmoid(x),
+     'tanh': lambda x, **kwargs: T.tanh(x), 'lrelu': lrelu, 'softmax': lambda x, **kwargs: T.nnet.softmax(x),
+     'linear': lambda x, **kwargs: x, 'elu': lambda x, **kwargs: T.nnet.elu(x), 'ramp': ramp, 'maxout': maxout,
+     'sin': lambda x, **kwargs: T.sin(x), 'cos': lambda x, **kwargs: T.cos(x), 'swish': swish, 'selu': selu,
+     'prelu': prelu, None: lambda x, **kwargs: x})
+
+
+@lru_cache(maxsize=None)
+def _activation_from_name(name):
+    try:
+        return function[name]
+    except KeyError:
+        raise NotImplementedError('Activation %s is not implemented' % name)
+
+
+def get_activation(activation):
+    """
+    resolves an activation spec to its callable. Strings (and None) are looked
+    up in :data:`function` once and cached, so every layer built with the same
+    name shares one function object. Callables are returned unchanged.
+
+    :param activation: an activation name in :data:`function` or a callable
+    :return: the callable implementing the activation
+    """
+    return activation if callable(activation) else _activation_from_name(activation)